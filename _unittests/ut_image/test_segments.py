@@ -5,11 +5,14 @@
 import os
 import unittest
 import math
+import numpy
+from PIL import Image
 from pyquickhelper.pycode import ExtTestCase, get_temp_folder
 from mlstatpy.image.detection_segment.geometrie import Point
-from mlstatpy.image.detection_segment.detection_segment_segangle import SegmentBord
+from mlstatpy.image.detection_segment.detection_segment_segangle import SegmentBord, enumerate_segments
 from mlstatpy.image.detection_segment.detection_segment import detect_segments, plot_segments
-from mlstatpy.image.detection_segment.detection_segment import _calcule_gradient, plot_gradient
+from mlstatpy.image.detection_segment.detection_segment import (
+    _calcule_gradient, _calcule_gradient_file, plot_gradient, clear_gradient_cache)
 from mlstatpy import __file__ as rootfile
 
 
@@ -110,6 +113,39 @@ class TestSegments(ExtTestCase):
         self.assertEqual(seg.b.x, 286)
         self.assertEqual(seg.b.y, 122)
 
+    def test_enumerate_segments(self):
+        for dim, dangle in [(Point(3, 4), math.pi / 24),
+                            (Point(163, 123), math.pi / 6)]:
+            s = SegmentBord(dim, dangle)
+            n = True
+            res = []
+            while n:
+                res.append(s.copy())
+                n = s.next()
+            segs = enumerate_segments(dim, dangle)
+            self.assertEqual(len(segs['ax']), len(res))
+            for i, seg in enumerate(res):
+                self.assertEqual(Point(segs['ax'][i], segs['ay'][i]), seg.a)
+                self.assertEqual(Point(segs['bx'][i], segs['by'][i]), seg.b)
+                self.assertEqual(segs['angle'][i], seg.angle)
+                self.assertEqual(segs['bord1'][i], seg.bord1)
+
+    def test_enumerate_segments_thin(self):
+        for dim in [Point(1, 4), Point(4, 1), Point(1, 1), Point(2, 1)]:
+            s = SegmentBord(dim, math.pi / 6)
+            n = True
+            res = []
+            while n:
+                res.append(s.copy())
+                n = s.next()
+            segs = enumerate_segments(dim, math.pi / 6)
+            self.assertEqual(len(segs['ax']), len(res))
+            for i, seg in enumerate(res):
+                self.assertEqual(Point(segs['ax'][i], segs['ay'][i]), seg.a)
+                self.assertEqual(Point(segs['bx'][i], segs['by'][i]), seg.b)
+                self.assertEqual(segs['angle'][i], seg.angle)
+                self.assertEqual(segs['bord1'][i], seg.bord1)
+
     def test_gradient_profile(self):
         img = os.path.join(os.path.dirname(__file__),
                            "data", "eglise_zoom2.jpg")
@@ -121,23 +157,51 @@ class TestSegments(ExtTestCase):
         self.assertIn("_calcule_gradient", short)
 
     def test_gradient(self):
-        temp = get_temp_folder(__file__, "temp_segment_gradient")
-        img = os.path.join(temp, "..", "data", "eglise_zoom2.jpg")
+        data = os.path.join(os.path.dirname(__file__), "data")
+        img = os.path.join(data, "eglise_zoom2.jpg")
         grad = _calcule_gradient(img, color=0)
         self.assertEqual(grad.shape, (308, 408, 2))
+        imgrads = {}
         for d in [-2, -1, 0, 1, 2]:
             imgrad = plot_gradient(img, grad, direction=d)
-            grfile = os.path.join(temp, "gradient-%d.png" % d)
-            imgrad.save(grfile)
-            self.assertExists(grfile)
-
-        with open(os.path.join(temp, "..", "data", "gradient--2.png"), 'rb') as f:
-            c1 = f.read()
-        with open(os.path.join(temp, "..", "data", "gradient--2b.png"), 'rb') as f:
-            c1b = f.read()
-        with open(os.path.join(temp, "gradient--2.png"), 'rb') as f:
-            c2 = f.read()
-        self.assertIn(c2, (c1, c1b))
+            self.assertEqual(imgrad.size, (408, 308))
+            imgrads[d] = imgrad
+
+        # images are compared in memory, no need to save them
+        c2 = numpy.asarray(imgrads[-2])
+        refs = [numpy.asarray(Image.open(os.path.join(data, name)))
+                for name in ["gradient--2.png", "gradient--2b.png"]]
+        self.assertTrue(any(c2.shape == ref.shape and numpy.array_equal(c2, ref)
+                            for ref in refs))
+
+    def test_gradient_cache(self):
+        temp = get_temp_folder(__file__, "temp_gradient_cache")
+        img = os.path.join(temp, "img.png")
+        rnd = numpy.random.RandomState(0)
+        data = rnd.randint(0, 255, (20, 30)).astype(numpy.uint8)
+        Image.fromarray(data).save(img)
+        clear_gradient_cache()
+        grad = _calcule_gradient(img)
+        self.assertEqualArray(grad, _calcule_gradient(data))
+        self.assertEqual(_calcule_gradient_file.cache_info().misses, 1)
+
+        # the cached gradient cannot be modified by the caller
+        grad[:, :, :] = 0
+        grad2 = _calcule_gradient(img)
+        self.assertEqual(_calcule_gradient_file.cache_info().hits, 1)
+        self.assertEqualArray(grad2, _calcule_gradient(data))
+
+        # the cache is invalidated when the file changes
+        data2 = data[::-1].copy()
+        Image.fromarray(data2).save(img)
+        st = os.stat(img)
+        os.utime(img, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        grad3 = _calcule_gradient(img)
+        self.assertEqual(_calcule_gradient_file.cache_info().misses, 2)
+        self.assertEqualArray(grad3, _calcule_gradient(data2))
+
+        clear_gradient_cache()
+        self.assertEqual(_calcule_gradient_file.cache_info().currsize, 0)
 
     def test_segment_detection_profile(self):
         img = os.path.join(os.path.dirname(__file__),
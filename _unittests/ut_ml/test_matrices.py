@@ -5,8 +5,9 @@
 import unittest
 import numpy
 import numpy.random as rnd
+import scipy.linalg
 from pyquickhelper.pycode import ExtTestCase
-from mlstatpy.ml.matrices import gram_schmidt, linear_regression, streaming_gram_schmidt
+from mlstatpy.ml.matrices import gram_schmidt, linear_regression, streaming_gram_schmidt, norm2
 from mlstatpy.ml.matrices import streaming_linear_regression, streaming_linear_regression_gram_schmidt
 
 
@@ -53,6 +54,52 @@ class TestMatrices(ExtTestCase):
         z2 = m.T @ m
         self.assertEqual(z2, numpy.identity(2))
 
+    def test_gram_schmidt_householder(self):
+        X = numpy.array([[1., 2., 3., 4.],
+                         [5., 6., 6., 6.],
+                         [5., 6., 7., 8.]])
+        T, P = gram_schmidt(X, change=True)
+        T2, P2 = gram_schmidt(X, change=True, method='householder')
+        self.assertEqualArray(T, T2, atol=1e-10)
+        self.assertEqualArray(P, P2, atol=1e-10)
+        T3 = gram_schmidt(X, method='householder')
+        self.assertEqualArray(T, T3, atol=1e-10)
+        self.assertRaise(lambda: gram_schmidt(X, method='gs'), ValueError)
+
+    def test_gram_schmidt_null_rows(self):
+        X = numpy.array([[0., 0., 0., 0., 0.],
+                         [1., 2., 3., 4., 1.],
+                         [5., 6., 6., 6., 0.],
+                         [0., 0., 0., 0., 0.],
+                         [5., 6., 7., 8., 2.]])
+        T, P = gram_schmidt(X, change=True)
+        self.assertEqualArray(P @ X, T, atol=1e-10)
+        self.assertEqualArray(T[[0, 3]], numpy.zeros((2, 5)))
+        valid = T[[1, 2, 4]]
+        self.assertEqualArray(valid @ valid.T, numpy.identity(3), atol=1e-10)
+        T2, P2 = gram_schmidt(X[[1, 2, 4]], change=True)
+        self.assertEqualArray(valid, T2, atol=1e-10)
+        self.assertEqualArray(P[[1, 2, 4]][:, [1, 2, 4]], P2, atol=1e-10)
+        self.assertEqualArray(gram_schmidt(numpy.zeros((2, 3))), numpy.zeros((2, 3)))
+
+    def test_gram_schmidt_float32(self):
+        X = numpy.array([[1., 2., 3., 4.],
+                         [5., 6., 6., 6.],
+                         [5., 6., 7., 8.]])
+        T, P = gram_schmidt(X, change=True)
+        for method in [None, 'householder']:
+            T32, P32 = gram_schmidt(X, change=True, method=method,
+                                    dtype=numpy.float32)
+            self.assertEqual(T32.dtype, numpy.float32)
+            self.assertEqual(P32.dtype, numpy.float32)
+            self.assertEqualArray(T, T32.astype(numpy.float64), atol=1e-4)
+            self.assertEqualArray(P, P32.astype(numpy.float64), atol=1e-3)
+        self.assertRaise(lambda: gram_schmidt(X, dtype=numpy.int64), ValueError)
+
+    def test_norm2(self):
+        X = numpy.array([[1., 2., 3.], [4., 5., 6.]])
+        self.assertEqualArray(norm2(X), numpy.array([14., 77.]))
+
     def test_linear_regression(self):
         X = numpy.array([[1, 0.5, 0], [0, 0.4, 2]], dtype=float).T
         y = numpy.array([1, 1.3, 3.9])
@@ -91,6 +138,46 @@ class TestMatrices(ExtTestCase):
         self.assertEqualArray(b1.ravel(), b3.ravel())
         self.assertEqualArray(b1.ravel(), b2.ravel())
 
+    def test_linear_regression_multi_target(self):
+        X = rnd.randn(100, 7)
+        Y = rnd.randn(100, 3)
+        for algo in [None, "gram", "qr"]:
+            with self.subTest(algo=algo):
+                B = linear_regression(X, Y, algo=algo)
+                self.assertEqual(B.shape, (7, 3))
+                for k in range(Y.shape[1]):
+                    b = linear_regression(X, Y[:, k], algo=algo)
+                    self.assertEqualArray(b, B[:, k], atol=1e-10)
+        exp = numpy.linalg.lstsq(X, Y, rcond=None)[0]
+        B2 = linear_regression(X.copy(), Y.copy(), algo='gelsd', overwrite=True)
+        self.assertEqualArray(exp, B2, atol=1e-10)
+        X2 = numpy.asfortranarray(X)
+        Y2 = numpy.asfortranarray(Y)
+        B3 = linear_regression(X2, Y2, algo='gelsd', overwrite=True)
+        self.assertEqualArray(exp, B3, atol=1e-10)
+
+    def test_linear_regression_lstsq(self):
+        for shape in [(50, 5), (4, 7)]:
+            for dtype in [numpy.float32, numpy.float64]:
+                for yshape in [(shape[0], ), (shape[0], 2)]:
+                    X = rnd.randn(*shape).astype(dtype)
+                    y = rnd.randn(*yshape).astype(dtype)
+                    exp = scipy.linalg.lstsq(X, y)[0]
+                    for algo in [None, 'gelsd']:
+                        got = linear_regression(X, y, algo=algo)
+                        self.assertEqual(exp.shape, got.shape)
+                        self.assertEqual(exp.dtype, got.dtype)
+                        self.assertEqualArray(exp, got, atol=1e-4)
+
+    def test_linear_regression_singular(self):
+        X = rnd.randn(50, 4)
+        X[:, 2] = 0
+        y = rnd.randn(50)
+        exp = scipy.linalg.lstsq(X, y)[0]
+        got = linear_regression(X, y)
+        self.assertEqualArray(exp, got, atol=1e-10)
+        self.assertEqual(got[2], 0)
+
     def test_inner_code(self):
 
         X = numpy.array([[1., 2., 3., 4.],
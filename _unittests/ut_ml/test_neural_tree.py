@@ -3,6 +3,7 @@
 @brief      test log(time=3s)
 """
 import io
+import copy
 import unittest
 import pickle
 import numpy
@@ -29,6 +30,15 @@ class TestNeuralTree(ExtTestCase):
         neu2 = pickle.load(st)
         self.assertTrue(neu == neu2)
 
+    def test_activation_integer(self):
+        x = numpy.array([1, 2])
+        xf = x.astype(numpy.float64)
+        for act in ['sigmoid', 'sigmoid4', 'softmax', 'softmax4',
+                    'relu', 'leakyrelu', 'identity']:
+            with self.subTest(act=act):
+                fct = NeuralTreeNode.get_activation_function(act)
+                self.assertEqualArray(fct(x).astype(numpy.float64), fct(xf))
+
     def test_neural_tree_network(self):
         net = NeuralTreeNet(3, empty=False)
         X = numpy.random.randn(2, 3)
@@ -56,6 +66,15 @@ class TestNeuralTree(ExtTestCase):
         rep = repr(net)
         self.assertEqual(rep, 'NeuralTreeNet(3)')
 
+    def test_neural_tree_network_numpy_dim(self):
+        net = NeuralTreeNet(numpy.int64(3), empty=False)
+        net.append(NeuralTreeNode(2, activation='softmax'), inputs=[2, 3])
+        self.assertEqual(net.size_, 6)
+        X = numpy.random.randn(2, 3)
+        net2 = net.copy()
+        self.assertEqualArray(net.predict(X), net2.predict(X))
+        self.assertEqualArray(net.predict(X)[:, 3], X.sum(axis=1))
+
     def test_neural_tree_network_copy(self):
         net = NeuralTreeNet(3, empty=False)
         net.append(NeuralTreeNode(1, activation='identity'),
@@ -64,6 +83,73 @@ class TestNeuralTree(ExtTestCase):
         X = numpy.random.randn(2, 3)
         self.assertEqualArray(net.predict(X), net2.predict(X))
 
+    def test_neural_tree_network_append_twice(self):
+        net = NeuralTreeNet(3, empty=False)
+        node = NeuralTreeNode(1, activation='identity')
+        net.append(node, inputs=[3])
+        self.assertRaise(lambda: net.append(node, inputs=[4]), RuntimeError)
+        net2 = NeuralTreeNet(3, empty=False)
+        self.assertRaise(lambda: net2.append(node, inputs=[3]), RuntimeError)
+        self.assertEqual(len(net), 2)
+        self.assertEqual(len(net2), 1)
+
+        # a copy does not share its coefficients with the first network
+        node2 = copy.deepcopy(node)
+        net2.append(node2, inputs=[3])
+        net2.update_training_weights(numpy.ones(net2.coefs_.shape))
+        self.assertEqualArray(net.training_weights, net.coefs_)
+        self.assertEqualArray(node.coef, net.coefs_[4:])
+        self.assertNotEqual(node.coef[0], node2.coef[0])
+        X = numpy.random.randn(2, 3)
+        self.assertEqualArray(net.predict(X)[:, -1],
+                              X.sum(axis=1) * node.coef[1] + node.coef[0])
+
+    def test_neural_tree_network_append_owner(self):
+        # a node unpickled with protocol 5 may hold a view
+        node = NeuralTreeNode(1, activation='identity')
+        node2 = pickle.loads(pickle.dumps(node, protocol=5))
+        net = NeuralTreeNet(3, empty=False)
+        net.append(node2, inputs=[3])
+        self.assertEqual(len(net), 2)
+
+        # nodes can be added to another network once cleared
+        nodes = list(net.nodes)
+        net.clear()
+        net2 = NeuralTreeNet(3, empty=True)
+        net2.append(nodes[0], inputs=[0, 1, 2])
+        net2.append(nodes[1], inputs=[3])
+        X = numpy.random.randn(2, 3)
+        self.assertEqualArray(
+            net2.predict(X)[:, -1],
+            X.sum(axis=1) * node2.coef[1] + node2.coef[0])
+        self.assertRaise(lambda: net.append(nodes[1], inputs=[3]),
+                         RuntimeError)
+
+    def test_neural_tree_network_setstate_dict(self):
+        net = NeuralTreeNet(3, empty=False)
+        net.append(NeuralTreeNode(1, activation='identity'), inputs=[3])
+        net.append(NeuralTreeNode(2, activation='softmax'), inputs=[3, 4])
+        state = net.__getstate__()
+        # previous versions stored the indices in dictionaries
+        state['output_to_node_'] = {}
+        state['input_to_node_'] = {}
+        for node, attr in zip(state['nodes'], state['nodes_attr']):
+            outputs = attr['output'] if isinstance(attr['output'], list) else [attr['output']]
+            for o in outputs:
+                state['output_to_node_'][o] = node, attr
+            for i in attr['inputs']:
+                state['input_to_node_'][i] = node, attr
+        net2 = pickle.loads(pickle.dumps(net))
+        net2.__setstate__(state)
+        size = net.size_
+        self.assertEqual(net2.size_, size)
+        self.assertEqualArray(net2.output_to_node_[:size], net.output_to_node_[:size])
+        self.assertEqualArray(net2.input_to_node_[:size], net.input_to_node_[:size])
+        X = numpy.random.randn(4, 3)
+        y = numpy.random.randn(4, 2)
+        self.assertEqualArray(net2.predict(X), net.predict(X))
+        self.assertEqualArray(net2.loss(X, y), net.loss(X, y))
+
     def test_neural_tree_network_append_dim2(self):
         net = NeuralTreeNet(3, empty=False)
         self.assertRaise(
@@ -83,6 +169,46 @@ class TestNeuralTree(ExtTestCase):
         rep = repr(net)
         self.assertEqual(rep, 'NeuralTreeNet(3)')
 
+    def _net_dim2(self):
+        net = NeuralTreeNet(3, empty=False)
+        net.append(NeuralTreeNode(numpy.ones((2, 1), dtype=numpy.float64),
+                                  activation='identity'),
+                   inputs=[3])
+        return net
+
+    def test_neural_tree_network_index(self):
+        net = self._net_dim2()
+        self.assertEqualArray(net.output_to_node_[:net.size_],
+                              numpy.array([-1, -1, -1, 0, 1, 1]))
+        self.assertEqualArray(net.input_to_node_[:net.size_],
+                              numpy.array([0, 0, 0, 1, -1, -1]))
+        node, attr = net._get_output_node_attr(2)
+        self.assertIs(node, net.nodes[-1])
+        self.assertEqual(attr['output'], [4, 5])
+
+    def test_neural_tree_network_plan(self):
+        net = self._net_dim2()
+        self.assertEqual(net.plan_[0][1:3], (slice(0, 3), 3))
+        self.assertEqual(net.plan_[1][1:3], (slice(3, 4), slice(4, 6)))
+        self.assertEqual(net.plan_[1][4], slice(4, 8))
+
+    def test_contiguous_index(self):
+        index = NeuralTreeNet._contiguous_index(numpy.array([0, 2]))
+        self.assertEqualArray(index, numpy.array([0, 2]))
+        index = NeuralTreeNet._contiguous_index(numpy.array([2, 4, 4]))
+        self.assertEqualArray(index, numpy.array([2, 4, 4]))
+        self.assertEqual(
+            NeuralTreeNet._contiguous_index(numpy.array([3, 4])), slice(3, 5))
+        self.assertEqual(
+            NeuralTreeNet._contiguous_index(range(2, 5)), slice(2, 5))
+
+    def test_neural_tree_network_output_node_cache(self):
+        net = self._net_dim2()
+        last_node = net.nodes[-1]
+        self.assertIs(net._get_output_node_attr(2)[0], last_node)
+        net.append(NeuralTreeNode(2, activation='identity'), inputs=[4, 5])
+        self.assertIs(net._get_output_node_attr(1)[0], net.nodes[-1])
+
     def test_convert(self):
         X = numpy.arange(8).astype(numpy.float64).reshape((-1, 2))
         y = ((X[:, 0] + X[:, 1] * 2) > 10).astype(numpy.int64)
@@ -103,6 +229,27 @@ class TestNeuralTree(ExtTestCase):
         self.assertEqual(exp.shape[0], got.shape[0])
         self.assertEqualArray(exp, got[:, -2:])
 
+    def test_convert_coefs_view(self):
+        data = load_iris()
+        X, y = data.data, data.target
+        y = y % 2
+        tree = DecisionTreeClassifier(max_depth=3, random_state=11)
+        tree.fit(X, y)
+        root = NeuralTreeNet.create_from_tree(tree, 10)
+
+        # every node keeps a view on the coefficients of the network
+        self.assertEqual(root.coefs_.size, sum(n.coef.size for n in root.nodes))
+        for node, attr in zip(root.nodes, root.nodes_attr):
+            first = attr['first_coef']
+            self.assertTrue(numpy.shares_memory(node.coef, root.coefs_))
+            self.assertEqualArray(
+                node.coef.ravel(), root.coefs_[first:first + attr['coef_size']])
+        root.update_training_weights(numpy.ones(root.coefs_.shape))
+        self.assertEqualArray(root.nodes[0].coef.ravel(),
+                              root.training_weights[:root.nodes[0].coef.size])
+        self.assertRaise(lambda: root.append(root.nodes[0], numpy.arange(4)),
+                         RuntimeError)
+
     def test_dot(self):
         data = load_iris()
         X, y = data.data, data.target
@@ -141,6 +288,22 @@ class TestNeuralTree(ExtTestCase):
         w2 = net.training_weights
         self.assertEqualArray(w2, w + delta)
 
+    def test_neural_tree_network_coefs_buffer(self):
+        net = NeuralTreeNet(3, empty=False)
+        for i in range(5):
+            net.append(NeuralTreeNode(1, activation='identity'),
+                       inputs=[3 + i])
+        self.assertEqual(net.shape, (14, ))
+        for node in net.nodes:
+            self.assertTrue(numpy.shares_memory(node.coef, net.coefs_))
+        w = net.training_weights
+        net.update_training_weights(numpy.arange(14) + 1.)
+        self.assertEqualArray(net.nodes[-1].coef, w[-2:] + [13, 14])
+        net2 = net.copy()
+        self.assertEqualArray(net2.training_weights, net.training_weights)
+        for node in net2.nodes:
+            self.assertTrue(numpy.shares_memory(node.coef, net2.coefs_))
+
     def test_training_weights(self):
         X = numpy.arange(8).astype(numpy.float64).reshape((-1, 2))
         y = ((X[:, 0] + X[:, 1] * 2) > 10).astype(numpy.int64)
@@ -196,6 +359,52 @@ class TestNeuralTree(ExtTestCase):
                 w0 = neu.training_weights
                 self.assertEqualArray(w0, numpy.zeros(w0.shape))
 
+    def test_gradient_softmax(self):
+        X = numpy.array([0.1, 0.2, -0.3])
+        w = numpy.array([[1, 2, 0.3], [-1, -2, 0.3], [0.5, 0.1, -0.2]])
+        b = numpy.array([-0.3, 0.4, 0.1])
+        g = numpy.array([-0.7, 0.2, 0.4])
+        for act, slant in [('softmax', 1), ('softmax4', 4)]:
+            with self.subTest(act=act):
+                neu = NeuralTreeNode(w, bias=b, activation=act)
+                pred = neu.predict(X)
+                jac = neu.gradient_(pred)
+                self.assertEqualArray(
+                    jac, (numpy.diag(pred) - numpy.outer(pred, pred)) * slant)
+                grad = neu.gradient_backward(g, X)
+                exp = numpy.outer(g @ jac, numpy.hstack([[1], X]))
+                self.assertEqualArray(grad, exp, decimal=10)
+                preds = neu.predict(numpy.vstack([X, -X]))
+                jacs = neu.gradient_(preds)
+                self.assertEqual(jacs.shape, (2, 3, 3))
+                self.assertEqualArray(jacs[0], jac)
+                self.assertEqualArray(jacs[1], neu.gradient_(preds[1]))
+
+    def test_gradients_dim2(self):
+        X = numpy.random.randn(5, 3)
+        for act, w, g in [
+                ('sigmoid', numpy.array([1, 2, 0.3]), numpy.random.randn(5)),
+                ('relu', numpy.array([1, 2, 0.3]), numpy.random.randn(5)),
+                ('sigmoid', numpy.array([[1, 2, 0.3], [-1, 0.5, 0.2]]),
+                 numpy.random.randn(5, 2)),
+                ('softmax', numpy.array([[1, 2, 0.3], [-1, 0.5, 0.2]]),
+                 numpy.random.randn(5, 2)),
+                ('softmax4', numpy.array([[1, 2, 0.3], [-1, 0.5, 0.2]]),
+                 numpy.random.randn(5, 2))]:
+            with self.subTest(act=act, shape=w.shape):
+                neu = NeuralTreeNode(w, activation=act)
+                gw = neu.gradient_backward(g, X)
+                gx = neu.gradient_backward(g, X, inputs=True)
+                self.assertEqual(gw.shape, neu.coef.shape)
+                self.assertEqual(gx.shape, X.shape)
+                exp_w = sum(neu.gradient_backward(g[i], X[i])
+                            for i in range(X.shape[0]))
+                self.assertEqualArray(gw, exp_w, decimal=10)
+                for i in range(X.shape[0]):
+                    self.assertEqualArray(
+                        gx[i], neu.gradient_backward(g[i], X[i], inputs=True),
+                        decimal=10)
+
     def test_optim_regression(self):
         X = numpy.abs(numpy.random.randn(10, 2))
         w0 = numpy.random.randn(3)
@@ -460,6 +669,41 @@ class TestNeuralTree(ExtTestCase):
         loss2 = root.loss(X, ny).sum()
         self.assertLess(loss2, loss1 + 100)
 
+    def test_fill_cache_dim2(self):
+        X = numpy.arange(16).astype(numpy.float64).reshape((-1, 2))
+        y = ((X[:, 0] + X[:, 1] * 2) > 15).astype(numpy.int64)
+        ny = label_class_to_softmax_output(y)
+
+        tree = DecisionTreeClassifier(max_depth=2)
+        tree.fit(X, y)
+        root = NeuralTreeNet.create_from_tree(tree, 10)
+        cache = root.fill_cache(X)
+        self.assertEqual(cache[-1].shape, (X.shape[0], root.size_))
+        self.assertEqualArray(cache[-1], root.predict(X))
+        for i in range(X.shape[0]):
+            one = root.fill_cache(X[i])
+            self.assertEqualArray(one[-1], cache[-1][i], decimal=12)
+        self.assertEqualArray(root.loss(X, ny, cache=cache),
+                              root.loss(X, ny))
+
+    def test_neural_net_gradient_dim2(self):
+        X = numpy.arange(16).astype(numpy.float64).reshape((-1, 2))
+        y = ((X[:, 0] + X[:, 1] * 2) > 15).astype(numpy.int64)
+        ny = label_class_to_softmax_output(y)
+
+        tree = DecisionTreeClassifier(max_depth=2)
+        tree.fit(X, y)
+        root = NeuralTreeNet.create_from_tree(tree, 1)
+        grad = root.gradient(X, ny)
+        self.assertEqual(grad.shape, root.training_weights.shape)
+        exp = sum(root.gradient(X[i], ny[i]) for i in range(X.shape[0]))
+        self.assertEqualArray(grad, exp, decimal=10)
+        grad = root.gradient(X, ny, inputs=True)
+        self.assertEqual(grad.shape, (X.shape[0], root.size_))
+        for i in range(X.shape[0]):
+            self.assertEqualArray(
+                grad[i], root.gradient(X[i], ny[i], inputs=True), decimal=10)
+
     def test_shape_dim2(self):
         X = numpy.random.randn(10, 3)
         w = numpy.array([[10, 20, 3], [-10, -20, 0.5]])
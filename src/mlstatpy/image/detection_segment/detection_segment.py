@@ -3,9 +3,11 @@
 @file
 @brief Détecte les segments dans une image.
 """
+import os
 import math
 import copy
 import time
+import functools
 import numpy
 from PIL import Image, ImageDraw
 from .queue_binom import tabule_queue_binom
@@ -63,6 +65,9 @@ def _load_image(img, format='PIL', mode=None):
         if format == 'PIL':
             return img
         elif format == 'array':
+            if img.mode in ('L', 'RGB'):
+                # conversion directe sans passer par une liste de pixels
+                return numpy.array(img, dtype=numpy.uint8)
             d1, d0 = img.size[1], img.size[0]
             img = numpy.array(img.getdata(), dtype=numpy.uint8)
             if len(img.shape) == 1:
@@ -97,10 +102,24 @@ def compute_gradient(img, color=None):
     """
     Retourne le gradient d'une image sous forme d'une matrice
     de Point, consideres ici comme des vecteurs.
+
+    Si *img* est un nom de fichier, le gradient est conservé
+    en mémoire pour les huit derniers fichiers, chacun occupe
+    16 octets par pixel (deux réels :epkg:`numpy:float64`),
+    soit 128 Mo pour huit images d'un million de pixels.
+    La fonction @see fn clear_gradient_cache libère cette mémoire.
     """
     return _calcule_gradient(img, color=color)
 
 
+def clear_gradient_cache():
+    """
+    Vide le cache des gradients calculés par @see fn compute_gradient
+    à partir d'un nom de fichier.
+    """
+    _calcule_gradient_file.cache_clear()
+
+
 def _calcule_gradient(img, color=None):
     """
     Retourne le gradient d'une image sous forme d'une matrice
@@ -113,24 +132,42 @@ def _calcule_gradient(img, color=None):
     @return             array of *shape (y, x, 2)*, first dimension is *dx*,
                         second one is *dy*
     """
+    if isinstance(img, str):
+        # le gradient d'un fichier est mis en cache tant que
+        # le fichier n'est pas modifié, une copie est retournée
+        # pour que le cache ne soit pas modifié par l'appelant
+        st = os.stat(img)
+        return _calcule_gradient_file(
+            os.path.abspath(img), st.st_mtime_ns, st.st_size, color).copy()
     img = _load_image(img, 'array')
     img = img.astype(numpy.float32)
     if color is not None:
         img = img[:, :, color]
 
-    dx1 = img[:, 1:-1] - img[:, :-2]
-    dx2 = img[:, 2:] - img[:, 1:-1]
-    dx = (dx1 + dx2) / 2
-
-    dy1 = img[1:-1, :] - img[:-2, :]
-    dy2 = img[2:, :] - img[1:-1, :]
-    dy = (dy1 + dy2) / 2
+    # ((x+1) - x + x - (x-1)) / 2 = ((x+1) - (x-1)) / 2,
+    # les différences sont écrites directement dans le résultat
     res = numpy.zeros(img.shape + (2,))
-    res[:, 1:-1, 0] = dx
-    res[1:-1, :, 1] = dy
+    dx = res[:, 1:-1, 0]
+    numpy.subtract(img[:, 2:], img[:, :-2], out=dx)
+    dx *= 0.5
+    dy = res[1:-1, :, 1]
+    numpy.subtract(img[2:, :], img[:-2, :], out=dy)
+    dy *= 0.5
     return res
 
 
+@functools.lru_cache(maxsize=8)
+def _calcule_gradient_file(filename, mtime, size, color):
+    """
+    Calcule le gradient d'une image stockée dans un fichier,
+    *mtime* et *size* ne servent qu'à invalider le cache
+    si le fichier est modifié. Le cache conserve au plus huit
+    gradients de 16 octets par pixel, il est vidé par
+    @see fn clear_gradient_cache.
+    """
+    return _calcule_gradient(_load_image(filename, 'array'), color=color)
+
+
 def plot_gradient(image, gradient, more=None, direction=-1):
     """
     Construit une image a partir de la matrice de gradient
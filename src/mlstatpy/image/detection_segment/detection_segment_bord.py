@@ -28,9 +28,15 @@ class SegmentBord_Commun(Segment):
 
     def copy(self):
         """
-        Copie l'instance.
+        Copie l'instance. Les attributs sont recopiés un à un,
+        c'est beaucoup plus rapide que ``copy.deepcopy``
+        qui explore récursivement l'objet.
         """
-        return copy.deepcopy(self)
+        res = self.__class__.__new__(self.__class__)
+        res.a = Point(self.a.x, self.a.y)
+        res.b = Point(self.b.x, self.b.y)
+        res.dim = Point(self.dim.x, self.dim.y)
+        return res
 
     def __str__(self):
         """permet d'afficher le segment"""
@@ -6,10 +6,16 @@ parcourir tous les segments de l'image.
 """
 import math
 import copy
+import numpy
 from .detection_segment_bord import SegmentBord_Commun
 from .geometrie import Point
 
 
+#: déplacement de la première extrémité sur chaque bord,
+#: 0 bord droit, 1 bord haut, 2 bord gauche, 3 bord bas
+_BORD_STEP = ((0, 1), (-1, 0), (0, -1), (1, 0))
+
+
 class SegmentBord(SegmentBord_Commun):
     """
     Définit un segment allant d'un bord à un autre de l'image,
@@ -52,6 +58,18 @@ class SegmentBord(SegmentBord_Commun):
         s += " -- vec " + "%2.2f,%2.2f" % (self.vecteur.x, self.vecteur.y)
         return s
 
+    def copy(self):
+        """
+        Copie l'instance sans passer par ``copy.deepcopy``.
+        """
+        res = SegmentBord_Commun.copy(self)
+        res.angle = self.angle
+        res.fin = Point(self.fin.x, self.fin.y)
+        res.vecteur = Point(self.vecteur.x, self.vecteur.y)
+        res.bord1 = self.bord1
+        res.dangle = self.dangle
+        return res
+
     def premier(self):
         """définit le premier segment, horizontal, part du bord gauche"""
         self.angle = 0
@@ -180,37 +198,16 @@ class SegmentBord(SegmentBord_Commun):
                 return True
         else:
             # on passe au segment suivant selon la meme orientation,
-            # tout depend du bord sur lequel on est
-            if self.bord1 == 0:
-                # bord droit
-                if self.a.y < self.dim.y - 1:
-                    # pas besoin de changer de bord
-                    self.a.y += 1
-                else:
-                    # on passe au bord suivant, bord haut
-                    self.bord1 = 1
-                    self.a.x -= 1
-            elif self.bord1 == 1:
-                # bord haut, meme raisonnement que pour le premier bord
-                if self.a.x > 0:
-                    self.a.x -= 1
-                else:
-                    self.bord1 = 2
-                    self.a.y -= 1
-            elif self.bord1 == 2:
-                # bord gauche, meme raisonnement que pour le premier bord
-                if self.a.y > 0:
-                    self.a.y -= 1
-                else:
-                    self.bord1 = 3
-                    self.a.x += 1
-            elif self.bord1 == 3:
-                # bord bas, meme raisonnement que pour le premier bord
-                if self.a.x < self.dim.x - 1:
-                    self.a.x += 1
-                else:
-                    self.bord1 = 0
-                    self.a.y += 1
+            # tout depend du bord sur lequel on est, si le pixel suivant
+            # sort de l'image, on passe au bord suivant
+            dx, dy = _BORD_STEP[self.bord1]
+            x, y = self.a.x + dx, self.a.y + dy
+            if x < 0 or y < 0 or x >= self.dim.x or y >= self.dim.y:
+                self.bord1 = (self.bord1 + 1) & 3
+                dx, dy = _BORD_STEP[self.bord1]
+                x, y = self.a.x + dx, self.a.y + dy
+            self.a.x = x
+            self.a.y = y
             # choisit une derniere extremite
             self.calcul_vecteur_fin()
             return True
@@ -244,3 +241,96 @@ class SegmentBord(SegmentBord_Commun):
             self.b.y = self.dim.y - 1
             r = 1
         return r
+
+
+def enumerate_segments(dim, dangle=math.pi / 24.0):
+    """
+    Enumère en une seule fois tous les segments parcourus
+    par @see cl SegmentBord, dans le même ordre que la méthode
+    @see me next. Le résultat est un ensemble de tableaux
+    :epkg:`numpy` (une ligne par segment) plutôt qu'une liste d'objets.
+
+    @param      dim         dimension de l'image, @see cl Point
+    @param      dangle      voir @see cl SegmentBord
+    @return                 dictionnaire ``{ax, ay, bx, by, angle, bord1}``
+
+    Les coordonnées ``ax, ay, bx, by`` et ``bord1`` sont des entiers,
+    ``angle`` est un réel. Pour une orientation donnée, la première
+    extrémité parcourt le contour de l'image dans le sens
+    bord 0 (droit), 1 (haut), 2 (gauche), 3 (bas). Le contour
+    est calculé une seule fois, chaque orientation en extrait
+    une portion.
+    """
+    X, Y = dim.x, dim.y
+    t = X + Y
+    if X < 2 or Y < 2:
+        # le contour d'une image d'un pixel de large ou de haut
+        # passe plusieurs fois par le même pixel, les segments
+        # sont obtenus avec la méthode next
+        return _enumerate_segments_next(dim, dangle)
+
+    # contour de l'image en partant du coin (X-1, 0), chaque pixel
+    # est associé au bord par lequel la méthode next y arrive
+    cx = numpy.hstack([[X - 1], numpy.full(Y - 1, X - 1), numpy.arange(X - 2, -1, -1),
+                       numpy.zeros(Y - 1, dtype=numpy.int64), numpy.arange(1, X - 1)])
+    cy = numpy.hstack([[0], numpy.arange(1, Y), numpy.full(X - 1, Y - 1),
+                       numpy.arange(Y - 2, -1, -1), numpy.zeros(X - 2, dtype=numpy.int64)])
+    cb = numpy.repeat(numpy.array([3, 0, 1, 2, 3]), [1, Y - 1, X - 1, Y - 1, X - 2])
+    L = cx.shape[0]
+    position = {(int(x), int(y)): i for i, (x, y) in enumerate(zip(cx, cy))}
+    cx2, cy2, cb2 = (numpy.hstack([c, c]) for c in (cx, cy, cb))
+
+    seg = SegmentBord(dim, dangle)
+    ax, ay, bord1, angle, vx, vy = [], [], [], [], [], []
+    while True:
+        first = position[seg.a.x, seg.a.y]
+        if seg.angle >= math.pi * 2 - 1e-5:
+            # comme la méthode next, seul le premier segment
+            # de cette orientation est visité
+            n = 1
+        else:
+            n = (position[seg.fin.x, seg.fin.y] - first) % L + 1
+        ax.append(cx2[first: first + n])
+        ay.append(cy2[first: first + n])
+        sb = cb2[first: first + n].copy()
+        sb[0] = seg.bord1
+        bord1.append(sb)
+        angle.append(numpy.full(n, seg.angle, dtype=numpy.float64))
+        vx.append(numpy.full(n, seg.vecteur.x, dtype=numpy.float64))
+        vy.append(numpy.full(n, seg.vecteur.y, dtype=numpy.float64))
+        if seg.angle >= math.pi * 2 - 1e-5:
+            break
+        seg.angle += dangle
+        seg.calcul_vecteur()
+        if seg.angle >= math.pi * 2:
+            break
+
+    ax = numpy.hstack(ax)
+    ay = numpy.hstack(ay)
+    vx = numpy.hstack(vx)
+    vy = numpy.hstack(vy)
+    # même calcul que la méthode calcul_vecteur_fin
+    bx = (ax + vx * t).astype(numpy.int64)
+    by = (ay + vy * t).astype(numpy.int64)
+    return dict(ax=ax, ay=ay, bx=bx, by=by, angle=numpy.hstack(angle),
+                bord1=numpy.hstack(bord1))
+
+
+def _enumerate_segments_next(dim, dangle):
+    """
+    Enumère les segments comme @see fn enumerate_segments
+    en appelant la méthode @see me next de @see cl SegmentBord.
+    """
+    seg = SegmentBord(dim, dangle)
+    rows = []
+    n = True
+    while n:
+        rows.append((seg.a.x, seg.a.y, seg.b.x, seg.b.y, seg.angle, seg.bord1))
+        n = seg.next()
+    ax, ay, bx, by, angle, bord1 = zip(*rows)
+    return dict(ax=numpy.array(ax, dtype=numpy.int64),
+                ay=numpy.array(ay, dtype=numpy.int64),
+                bx=numpy.array(bx, dtype=numpy.int64),
+                by=numpy.array(by, dtype=numpy.int64),
+                angle=numpy.array(angle, dtype=numpy.float64),
+                bord1=numpy.array(bord1, dtype=numpy.int64))
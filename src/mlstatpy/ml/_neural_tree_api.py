@@ -65,6 +65,8 @@ class _TrainingAPI:
     def gradient(self, X, y, inputs=False):
         """
         Computes the gradient in *X* knowing the expected value *y*.
+        If *X* is a matrix, the gradient against the coefficients
+        is summed over all rows.
 
         :param X: computes the gradient in X
         :param y: expected values
@@ -72,9 +74,9 @@ class _TrainingAPI:
             otherwise against the inputs.
         :return: gradient
         """
-        if len(X.shape) != 1:
+        if len(X.shape) not in (1, 2):
             raise ValueError(  # pragma: no cover
-                "X must a vector of one dimension but has shape {}.".format(X.shape))
+                "X must a vector or a matrix but has shape {}.".format(X.shape))
         cache = self.fill_cache(X)  # pylint: disable=E1128
         dlossds = self.dlossds(X, y, cache=cache)
         return self.gradient_backward(dlossds, X, inputs=inputs, cache=cache)
@@ -14,6 +14,20 @@ class NeuralTreeNode(_TrainingAPI):
     One node in a neural network.
     """
 
+    @staticmethod
+    def _identity(x):
+        "Identity function."
+        return x
+
+    @staticmethod
+    def _sigmoid4(x):
+        "Sigmoid function with a slant of 4."
+        # 4. and not 4, integers are converted into floats
+        y = x * 4.
+        if isinstance(y, numpy.ndarray):
+            return expit(y, out=y)
+        return expit(y)
+
     @staticmethod
     def _relu(x):
         "Relu function."
@@ -22,28 +36,40 @@ class NeuralTreeNode(_TrainingAPI):
     @staticmethod
     def _leakyrelu(x):
         "Leaky Relu function."
-        return numpy.maximum(x, 0) + numpy.minimum(x, 0) * 0.01
+        return numpy.where(x > 0, x, x * 0.01)
 
     @staticmethod
-    def _drelu(x):
-        "Derivative of the Relu function."
-        res = numpy.ones(x.shape, dtype=x.dtype)
-        res[x < 0] = 0.
-        return res
+    def _drelu(y):
+        """
+        Derivative of the Relu function,
+        *y* is the output of the Relu function.
+        """
+        return (y > 0).astype(y.dtype)
 
     @staticmethod
-    def _dleakyrelu(x):
-        "Derivative of the Leaky Relu function."
-        res = numpy.ones(x.shape, dtype=x.dtype)
-        res[x < 0] = 0.01
-        return res
+    def _dleakyrelu(y):
+        """
+        Derivative of the Leaky Relu function,
+        *y* is the output of the Leaky Relu function.
+        """
+        return numpy.where(y < 0, 0.01, 1.).astype(y.dtype, copy=False)
 
     @staticmethod
-    def _dsigmoid(x):
-        "Derivativ of the sigmoid function."
-        y = expit(x)
+    def _dsigmoid(y):
+        """
+        Derivative of the sigmoid function,
+        *y* is the output of the sigmoid function.
+        """
         return y * (1 - y)
 
+    @staticmethod
+    def _dsigmoid4(y):
+        """
+        Derivative of the sigmoid function with a slant of 4,
+        *y* is the output of the sigmoid function.
+        """
+        return y * (1 - y) * 4
+
     @staticmethod
     def _softmax(x):
         "Derivative of the softmax function."
@@ -52,12 +78,35 @@ class NeuralTreeNode(_TrainingAPI):
         return softmax(x)
 
     @staticmethod
-    def _dsoftmax(x):
-        "Derivative of the softmax function."
-        soft = softmax(x)
-        grad = - soft @ soft.T
-        diag = numpy.diag(soft)
-        return diag + grad
+    def _dsoftmax(y):
+        """
+        Derivative of the softmax function,
+        *y* is the output of the softmax function.
+        If *y* is a matrix, it returns one jacobian per row.
+        """
+        if len(y.shape) == 2:
+            jac = numpy.einsum('ni,nj->nij', y, -y)
+            diag = numpy.einsum('nii->ni', jac)
+            diag += y
+            return jac
+        return numpy.diag(y) - numpy.outer(y, y)
+
+    @staticmethod
+    def _softmax4(x):
+        "Softmax function with a slant of 4."
+        y = x * 4.
+        y -= y.max(axis=-1, keepdims=True)
+        numpy.exp(y, out=y)
+        y /= y.sum(axis=-1, keepdims=True)
+        return y
+
+    @staticmethod
+    def _dsoftmax4(y):
+        """
+        Derivative of the softmax function with a slant of 4,
+        *y* is the output of the softmax function.
+        """
+        return NeuralTreeNode._dsoftmax(y) * 4
 
     @staticmethod
     def get_activation_function(activation):
@@ -68,17 +117,17 @@ class NeuralTreeNode(_TrainingAPI):
         if activation == 'softmax':
             return NeuralTreeNode._softmax
         if activation == 'softmax4':
-            return lambda x: NeuralTreeNode._softmax(x * 4)
+            return NeuralTreeNode._softmax4
         if activation in {'logistic', 'expit', 'sigmoid'}:
             return expit
         if activation == 'sigmoid4':
-            return lambda x: expit(x * 4)
+            return NeuralTreeNode._sigmoid4
         if activation == 'relu':
             return NeuralTreeNode._relu
         if activation == 'leakyrelu':
             return NeuralTreeNode._leakyrelu
         if activation == 'identity':
-            return lambda x: x
+            return NeuralTreeNode._identity
         raise ValueError(
             "Unknown activation function '{}'.".format(activation))
 
@@ -86,7 +135,8 @@ class NeuralTreeNode(_TrainingAPI):
     def get_activation_gradient_function(activation):
         """
         Returns the activation function.
-        It returns a function *y=f'(x)*.
+        It returns a function *y=f'(x)* expressed with
+        the output of the activation function *f(x)*.
         About the sigmoid:
 
         .. math::
@@ -99,17 +149,17 @@ class NeuralTreeNode(_TrainingAPI):
         if activation == 'softmax':
             return NeuralTreeNode._dsoftmax
         if activation == 'softmax4':
-            return lambda x: NeuralTreeNode._dsoftmax(x) * 4
+            return NeuralTreeNode._dsoftmax4
         if activation in {'logistic', 'expit', 'sigmoid'}:
             return NeuralTreeNode._dsigmoid
         if activation == 'sigmoid4':
-            return lambda x: NeuralTreeNode._dsigmoid(x) * 4
+            return NeuralTreeNode._dsigmoid4
         if activation == 'relu':
             return NeuralTreeNode._drelu
         if activation == 'leakyrelu':
             return NeuralTreeNode._dleakyrelu
         if activation == 'identity':
-            return lambda x: numpy.ones(x.shape, dtype=x.dtype)
+            return numpy.ones_like
         raise ValueError(
             "Unknown activation gradient function '{}'.".format(activation))
 
@@ -154,7 +204,7 @@ class NeuralTreeNode(_TrainingAPI):
             cst = numpy.finfo(numpy.float32).eps
 
             def dclsdx(x, y):
-                return numpy.log(x + cst) - numpy.log(y + cst)
+                return numpy.log((x + cst) / (y + cst))
 
             return dclsdx
 
@@ -210,19 +260,34 @@ class NeuralTreeNode(_TrainingAPI):
             raise RuntimeError(  # pragma: no cover
                 "Unexpected weights shape: {}".format(weights.shape))
 
+        self.coef_flat_ = self.coef.reshape(-1)
         self.activation = activation
         self.nodeid = nodeid
         self._set_fcts()
 
+    @classmethod
+    def _from_coef(cls, coef, activation, tag=None):
+        """
+        Creates a node from coefficients already laid out
+        as attribute *coef* (bias first), *coef* is not copied.
+        """
+        node = cls.__new__(cls)
+        node.tag = tag
+        node.n_outputs = 1 if len(coef.shape) == 1 else coef.shape[0]
+        node.coef = coef
+        node.coef_flat_ = coef.reshape(-1)
+        node.activation = activation
+        node.nodeid = -1
+        node._set_fcts()
+        return node
+
     def _set_fcts(self):
-        self.activation_ = NeuralTreeNode.get_activation_function(
-            self.activation)
-        self.gradient_ = NeuralTreeNode.get_activation_gradient_function(
-            self.activation)
-        self.losss_ = NeuralTreeNode.get_activation_loss_function(
-            self.activation)
-        self.dlossds_ = NeuralTreeNode.get_activation_dloss_function(
-            self.activation)
+        fcts = _ACTIVATION_REGISTRY.get(self.activation, None)
+        if fcts is None:
+            raise ValueError(
+                "Unknown activation function '{}'.".format(self.activation))
+        (self.activation_, self.gradient_,
+         self.losss_, self.dlossds_) = fcts
 
     @property
     def input_weights(self):
@@ -248,6 +313,7 @@ class NeuralTreeNode(_TrainingAPI):
     def __setstate__(self, state):
         "usual"
         self.coef = state['coef']
+        self.coef_flat_ = self.coef.reshape(-1)
         self.activation = state['activation']
         self.nodeid = state['nodeid']
         self.n_outputs = state['n_outputs']
@@ -255,9 +321,7 @@ class NeuralTreeNode(_TrainingAPI):
         self._set_fcts()
 
     def __eq__(self, obj):
-        if self.coef.shape != obj.coef.shape:
-            return False
-        if any(map(lambda xy: xy[0] != xy[1], zip(self.coef, obj.coef))):
+        if not numpy.array_equal(self.coef, obj.coef):
             return False
         if self.activation != obj.activation:
             return False
@@ -277,17 +341,13 @@ class NeuralTreeNode(_TrainingAPI):
         "Computes inputs of the activation function."
         if self.n_outputs == 1:
             return X @ self.coef[1:] + self.coef[0]
-        return (X.reshape((1, -1)) @ self.coef[:, 1:].T + self.coef[:, 0]).ravel()
+        if len(X.shape) == 2:
+            return X @ self.coef[:, 1:].T + self.coef[:, 0]
+        return self.coef[:, 1:] @ X + self.coef[:, 0]
 
     def predict(self, X):
         "Computes neuron outputs."
-        if self.n_outputs == 1:
-            return self.activation_(X @ self.coef[1:] + self.coef[0])
-        if len(X.shape) == 2:
-            return self.activation_(
-                (X @ self.coef[:, 1:].T + self.coef[:, 0]))
-        return self.activation_(
-            (X.reshape((1, -1)) @ self.coef[:, 1:].T + self.coef[:, 0]).ravel())
+        return self.activation_(self._predict(X))
 
     @property
     def ndim(self):
@@ -297,7 +357,7 @@ class NeuralTreeNode(_TrainingAPI):
     @property
     def training_weights(self):
         "Returns the weights stored in the neuron."
-        return self.coef.ravel()
+        return self.coef_flat_
 
     def update_training_weights(self, X, add=True):
         """
@@ -307,19 +367,18 @@ class NeuralTreeNode(_TrainingAPI):
         :param add: addition or replace
         """
         if add:
-            self.coef += X.reshape(self.coef.shape)
+            self.coef_flat_ += X
         else:
-            numpy.copyto(self.coef, X.reshape(self.coef.shape))
+            numpy.copyto(self.coef_flat_, X)
 
     def fill_cache(self, X):
         """
         Creates a cache with intermediate results.
-        ``lX`` is the results before the activation function,
         ``aX`` is the results after the activation function, the prediction.
+        The gradients are computed from the prediction, the results
+        before the activation function are not kept.
         """
-        cache = dict(lX=self._predict(X))
-        cache['aX'] = self.activation_(cache['lX'])
-        return cache
+        return dict(aX=self.activation_(self._predict(X)))
 
     def _common_loss_dloss(self, X, y, cache=None):
         """
@@ -348,9 +407,67 @@ class NeuralTreeNode(_TrainingAPI):
         act = self._common_loss_dloss(X, y, cache=cache)
         return self.dlossds_(act, y)
 
+    def _gradient_activation(self, graddx, cache):
+        """
+        Computes the gradient against the results
+        before the activation function. If the cache holds
+        a batch of predictions, *graddx* holds one gradient per row.
+        """
+        pred = cache['aX']
+        if self.activation.startswith('softmax'):
+            # graddx @ (diag(s) - s s') without building the jacobian
+            if len(pred.shape) == 2:
+                f = pred * (graddx - numpy.einsum(
+                    'ij,ij->i', graddx, pred).reshape((-1, 1)))
+            else:
+                f = pred * (graddx - numpy.dot(graddx, pred))
+            if self.activation == 'softmax4':
+                f *= 4
+            return f
+        # other activations are applied elementwise
+        return graddx * self.gradient_(pred)
+
+    def _gradient_inputs(self, f, X):
+        """
+        Computes the gradient against the inputs,
+        one row per observation if *X* is a matrix.
+        """
+        if len(self.coef.shape) == 1:
+            if len(X.shape) == 2:
+                return numpy.multiply.outer(f, self.coef[1:])
+            return self.coef[1:] * f
+        return f @ self.coef[:, 1:]
+
+    def _gradient_coef(self, f, X, out=None):
+        """
+        Computes the gradient against the coefficients,
+        the result is written into *out* if not None.
+        If *X* is a matrix, the gradients of every observation
+        are summed with a matrix product.
+        """
+        rgrad = numpy.empty(self.coef.shape) if out is None else out
+        if len(X.shape) == 2:
+            if len(self.coef.shape) == 1:
+                rgrad[:1] = f.sum()
+                numpy.dot(f, X, out=rgrad[1:])
+            else:
+                numpy.sum(f, axis=0, out=rgrad[:, 0])
+                rgrad[:, 1:] = f.T @ X
+            return rgrad
+        if len(self.coef.shape) == 1:
+            rgrad[:1] = f
+            numpy.multiply(X, f, out=rgrad[1:])
+        else:
+            rgrad[:, 0] = f
+            numpy.multiply(f.reshape((-1, 1)), X, out=rgrad[:, 1:])
+        return rgrad
+
     def gradient_backward(self, graddx, X, inputs=False, cache=None):
         """
         Computes the gradients at point *X*.
+        If *X* is a matrix, the gradient against the coefficients
+        is the sum of the gradients of every row, the gradient
+        against the inputs has one row per observation.
 
         :param graddx: existing gradient against the inputs
         :param X: computes the gradient in X
@@ -361,31 +478,32 @@ class NeuralTreeNode(_TrainingAPI):
         """
         if cache is None:
             cache = self.fill_cache(X)
-
-        pred = cache['aX']
-        ga = self.gradient_(pred)
-        if len(ga.shape) == 2:
-            f = graddx @ ga
-        else:
-            f = graddx * ga
-
+        f = self._gradient_activation(graddx, cache)
         if inputs:
-            if len(self.coef.shape) == 1:
-                rgrad = numpy.empty(X.shape)
-                rgrad[:] = self.coef[1:]
-                rgrad *= f
-            else:
-                rgrad = numpy.sum(
-                    self.coef[:, 1:] * f.reshape((-1, 1)), axis=0)
-            return rgrad
+            return self._gradient_inputs(f, X)
+        return self._gradient_coef(f, X)
 
-        rgrad = numpy.empty(self.coef.shape)
-        if len(self.coef.shape) == 1:
-            rgrad[0] = 1
-            rgrad[1:] = X
-            rgrad *= f
-        else:
-            rgrad[:, 0] = 1
-            rgrad[:, 1:] = X
-            rgrad *= f.reshape((-1, 1))
-        return rgrad
+    def _gradient_backward_both(self, graddx, X, cache, out=None):
+        """
+        Computes the gradients against the coefficients and
+        against the inputs, the activation gradient is computed once.
+
+        :param graddx: existing gradient against the inputs
+        :param X: computes the gradient in X
+        :param cache: cache intermediate results
+        :param out: if not None, the gradient against the coefficients
+            is written into this array which has the shape of *coef*
+        :return: gradient against the coefficients, gradient against the inputs
+        """
+        f = self._gradient_activation(graddx, cache)
+        return (self._gradient_coef(f, X, out=out),
+                self._gradient_inputs(f, X))
+
+
+_ACTIVATION_REGISTRY = {
+    _act: (NeuralTreeNode.get_activation_function(_act),
+           NeuralTreeNode.get_activation_gradient_function(_act),
+           NeuralTreeNode.get_activation_loss_function(_act),
+           NeuralTreeNode.get_activation_dloss_function(_act))
+    for _act in ['softmax', 'softmax4', 'logistic', 'expit', 'sigmoid',
+                 'sigmoid4', 'relu', 'leakyrelu', 'identity']}
@@ -5,6 +5,7 @@
 """
 from io import BytesIO
 import pickle
+import weakref
 import numpy
 from ._neural_tree_api import _TrainingAPI
 from ._neural_tree_node import NeuralTreeNode
@@ -87,35 +88,158 @@ class NeuralTreeNet(_TrainingAPI):
         cop = BytesIO(st.getvalue())
         return pickle.load(cop)
 
-    def _update_members(self, node=None, attr=None):
-        "Updates internal members."
+    def _update_members(self, node=None, attr=None, buffer=None):
+        """
+        Updates internal members, *buffer* is given to
+        @see me _bind_coefs when all members are rebuilt.
+        """
+        self.output_node_cache_ = {}
         if node is None or attr is None:
             if len(self.nodes_attr) == 0:
                 self.size_ = self.dim
             else:
-                self.size_ = max(d['output'] for d in self.nodes_attr) + 1
-            self.output_to_node_ = {}
-            self.input_to_node_ = {}
-            for node2, attr2 in zip(self.nodes, self.nodes_attr):
-                if isinstance(attr2['output'], list):
-                    for o in attr2['output']:
-                        self.output_to_node_[o] = node2, attr2
-                else:
-                    self.output_to_node_[attr2['output']] = node2, attr2
-                for i in attr2['inputs']:
-                    self.input_to_node_[i] = node2, attr2
+                self.size_ = max(
+                    max(d['output']) if isinstance(d['output'], (list, tuple)) else d['output']
+                    for d in self.nodes_attr) + 1
+            self.output_to_node_ = numpy.full(
+                (self.size_, ), -1, dtype=numpy.int32)
+            self.input_to_node_ = numpy.full(
+                (self.size_, ), -1, dtype=numpy.int32)
+            self.plan_ = [self._plan_step(node2, attr2)
+                          for node2, attr2 in zip(self.nodes, self.nodes_attr)]
+            self._bind_coefs(buffer=buffer)
+            for index, attr2 in enumerate(self.nodes_attr):
+                self._index_node(index, attr2)
         else:
             if len(node.input_weights.shape) == 1:
                 self.size_ += 1
             else:
                 self.size_ += node.input_weights.shape[0]
-            if isinstance(attr['output'], list):
-                for o in attr['output']:
-                    self.output_to_node_[o] = node, attr
-            else:
-                self.output_to_node_[attr['output']] = node, attr
-            for i in attr['inputs']:
-                self.input_to_node_[i] = node, attr
+            self._index_node(len(self.nodes) - 1, attr)
+            self.plan_.append(self._plan_step(node, attr))
+            self._bind_node_coef(node)
+
+    def _index_node(self, index, attr):
+        """
+        Stores the index of node *index* for its outputs and inputs
+        in ``output_to_node_`` and ``input_to_node_``,
+        both arrays double their capacity when they are full.
+        """
+        capacity = self.output_to_node_.shape[0]
+        if self.size_ > capacity:
+            capacity = max(self.size_, capacity * 2)
+            for name in ['output_to_node_', 'input_to_node_']:
+                old = getattr(self, name)
+                new = numpy.full((capacity, ), -1, dtype=numpy.int32)
+                new[:old.shape[0]] = old
+                setattr(self, name, new)
+        self.output_to_node_[attr['output']] = index
+        self.input_to_node_[attr['inputs']] = index
+
+    def _bind_coefs(self, capacity=0, buffer=None):
+        """
+        Stores the coefficients of all nodes in a single buffer,
+        every node keeps a view on its part of the buffer.
+        The training weights are then a contiguous vector
+        and can be updated with a single operation.
+        If *buffer* is not None, the coefficients of every node
+        are already views on consecutive parts of it and
+        the buffer is used as it is.
+        Every node keeps a weak reference to the network
+        in attribute ``owner_``.
+        """
+        size = sum(n.coef.size for n in self.nodes)
+        owner = weakref.ref(self)
+        for n in self.nodes:
+            n.owner_ = owner
+        if buffer is not None:
+            self.coefs_buffer_ = buffer
+            self.coefs_ = buffer[:size]
+            return
+        buffer = numpy.empty(max(capacity, size), dtype=numpy.float64)
+        pos = 0
+        for n in self.nodes:
+            flat = buffer[pos: pos + n.coef.size]
+            view = flat.reshape(n.coef.shape)
+            view[...] = n.coef
+            n.coef = view
+            n.coef_flat_ = flat
+            pos += view.size
+        self.coefs_buffer_ = buffer
+        self.coefs_ = buffer[:size]
+
+    def _bind_node_coef(self, node):
+        """
+        Moves the coefficients of the last added node into the buffer
+        holding all coefficients, the buffer capacity is doubled
+        when it is full.
+        """
+        pos = self.coefs_.size
+        size = pos + node.coef.size
+        if size > self.coefs_buffer_.size:
+            self._bind_coefs(capacity=size * 2)
+            return
+        flat = self.coefs_buffer_[pos: size]
+        view = flat.reshape(node.coef.shape)
+        view[...] = node.coef
+        node.coef = view
+        node.coef_flat_ = flat
+        node.owner_ = weakref.ref(self)
+        self.coefs_ = self.coefs_buffer_[:size]
+
+    def __getstate__(self):
+        "usual"
+        state = self.__dict__.copy()
+        for k in ['plan_', 'coefs_buffer_', 'coefs_', 'output_node_cache_']:
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        "usual"
+        self.__dict__.update(state)
+        # the indices are rebuilt, older versions stored them
+        # in dictionaries
+        self._update_members()
+
+    @staticmethod
+    def _plan_step(node, attr):
+        """
+        Every node is evaluated with the same sequence of operations,
+        they are stored in a tuple to avoid looking up the attributes
+        for every node and every prediction: the prediction function,
+        the inputs, the outputs, the node and the position of its
+        coefficients in the training weights.
+        The outputs of a node are always consecutive positions.
+        """
+        first = attr['first_coef']
+        output = attr['output']
+        if isinstance(output, (list, tuple)):
+            output = slice(output[0], output[-1] + 1)
+        return (node.predict,
+                NeuralTreeNet._contiguous_index(attr['inputs']),
+                output, node, slice(first, first + attr['coef_size']))
+
+    @staticmethod
+    def _contiguous_index(index):
+        """
+        Returns a slice if *index* is a range of consecutive
+        positions, indexing with a slice returns a view
+        instead of a copy, *index* is returned otherwise.
+        The first and last positions are checked first,
+        the other ones only if they are consistent.
+        """
+        if isinstance(index, (int, numpy.integer)):
+            return index
+        if isinstance(index, range) and index.step == 1:
+            return slice(index.start, index.stop)
+        n = len(index)
+        if n == 0 or index[-1] - index[0] + 1 != n:
+            return index
+        if n > 2:
+            index = numpy.asarray(index)
+            if not (index[1:] - index[:-1] == 1).all():
+                return index
+        return slice(int(index[0]), int(index[-1]) + 1)
 
     def __repr__(self):
         "usual"
@@ -123,6 +247,12 @@ class NeuralTreeNet(_TrainingAPI):
 
     def clear(self):
         "Clear all nodes"
+        # the nodes get their own copy of their coefficients
+        # and can be added to another network
+        for n in self.nodes:
+            n.coef = n.coef.copy()
+            n.coef_flat_ = n.coef.reshape(-1)
+            n.owner_ = None
         del self.nodes[:]
         del self.nodes_attr[:]
         self._update_members()
@@ -133,7 +263,17 @@ class NeuralTreeNet(_TrainingAPI):
 
         @param      node        node to add
         @param      inputs      index of input nodes
+
+        The network stores the coefficients of the node in its own
+        buffer, *node* cannot be added twice or to another network
+        until it is cleared, :func:`copy.deepcopy` returns a node
+        which can be added.
         """
+        owner = getattr(node, 'owner_', None)
+        if owner is not None and owner() is not None:
+            raise RuntimeError(
+                "Node {} already belongs to a network, "
+                "a copy should be appended.".format(node.nodeid))
         if len(node.input_weights.shape) == 1:
             if node.input_weights.shape[0] != len(inputs):
                 raise RuntimeError(
@@ -176,17 +316,20 @@ class NeuralTreeNet(_TrainingAPI):
         return len(self.nodes)
 
     def _predict_one(self, X):
-        res = numpy.zeros((self.size_,), dtype=numpy.float64)
+        # every position is written by the inputs or by one node
+        res = numpy.empty((self.size_,), dtype=numpy.float64)
         res[:self.dim] = X
-        for node, attr in zip(self.nodes, self.nodes_attr):
-            res[attr['output']] = node.predict(res[attr['inputs']])
+        for predict, inputs, output, _, _ in self.plan_:
+            res[output] = predict(res[inputs])
         return res
 
     def predict(self, X):
         if len(X.shape) == 2:
-            res = numpy.zeros((X.shape[0], self.size_))
-            for i, x in enumerate(X):
-                res[i, :] = self._predict_one(x)
+            # every node processes all rows at once
+            res = numpy.empty((X.shape[0], self.size_), dtype=numpy.float64)
+            res[:, :self.dim] = X
+            for predict, inputs, output, _, _ in self.plan_:
+                res[:, output] = predict(res[:, inputs])
             return res
         return self._predict_one(X)
 
@@ -213,55 +356,43 @@ class NeuralTreeNet(_TrainingAPI):
         threshold = tree.tree_.threshold
         value = tree.tree_.value.reshape((-1, 2))
         output_class = (value[:, 1] > value[:, 0]).astype(numpy.int64)
-        max_features_ = tree.max_features_
+        dim = tree.max_features_
 
-        root = NeuralTreeNet(tree.max_features_, empty=True)
-        feat_index = numpy.arange(0, max_features_)
+        root = NeuralTreeNet(dim, empty=True)
+        feat_index = numpy.arange(0, dim)
         predecessor = {}
         outputs = {i: [] for i in range(0, tree.n_classes_)}
+
+        # The structure of the network is built first, every node
+        # is a kind (threshold, true, false with two inputs,
+        # false with one input), a tag and its inputs, the output
+        # of node j is dim + j. The coefficients of all nodes are then
+        # written at once in a single buffer the network keeps.
+        kinds = []
+        tags = []
+        inputs = []
         for i in range(n_nodes):
 
             if children_left[i] != children_right[i]:
                 # node with a threshold
-                # right side
-                coef = numpy.zeros((max_features_,), dtype=numpy.float64)
-                coef[feature[i]] = -k
-                node_th = NeuralTreeNode(coef, bias=k * threshold[i],
-                                         activation='sigmoid4', tag="N%d-th" % i)
-                root.append(node_th, feat_index)
+                th = len(kinds)
+                kinds.append(0)
+                tags.append("N%d-th" % i)
+                inputs.append(feat_index)
 
                 if i in predecessor:
-                    pred = predecessor[i]
-                    node1 = pred
-                    node2 = node_th
-                    attr1 = root[node1.nodeid][1]
-                    attr2 = root[node2.nodeid][1]
-
-                    coef = numpy.ones((2,), dtype=numpy.float64) * k
-                    node_true = NeuralTreeNode(coef, bias=-k * 1.5,
-                                               activation='sigmoid4',
-                                               tag="N%d-T" % i)
-                    root.append(node_true, [attr1['output'], attr2['output']])
-
-                    coef = numpy.zeros((2,), dtype=numpy.float64)
-                    coef[0] = k
-                    coef[1] = -k
-                    node_false = NeuralTreeNode(coef, bias=-k * 0.25,
-                                                activation='sigmoid4',
-                                                tag="N%d-F" % i)
-                    root.append(node_false, [attr1['output'], attr2['output']])
-
-                    predecessor[children_left[i]] = node_true
-                    predecessor[children_right[i]] = node_false
+                    both = numpy.array([dim + predecessor[i], dim + th])
+                    kinds.extend((1, 2))
+                    tags.extend(("N%d-T" % i, "N%d-F" % i))
+                    inputs.extend((both, both))
+                    predecessor[children_left[i]] = th + 1
+                    predecessor[children_right[i]] = th + 2
                 else:
-                    coef = numpy.ones((1,), dtype=numpy.float64) * -1
-                    node_false = NeuralTreeNode(
-                        coef, bias=1, activation='identity', tag="N%d-F" % i)
-                    attr = root[node_th.nodeid][1]
-                    root.append(node_false, [attr['output']])
-
-                    predecessor[children_left[i]] = node_th
-                    predecessor[children_right[i]] = node_false
+                    kinds.append(3)
+                    tags.append("N%d-F" % i)
+                    inputs.append(numpy.array([dim + th]))
+                    predecessor[children_left[i]] = th
+                    predecessor[children_right[i]] = th + 1
 
             elif i in predecessor:
                 # leave
@@ -270,21 +401,55 @@ class NeuralTreeNet(_TrainingAPI):
         # final node
         output = []
         index = [0]
-        nb = []
         for i in range(0, tree.n_classes_):
             output.extend(outputs[i])
-            nb.append(len(outputs[i]))
             index.append(len(outputs[i]) + index[-1])
-        coef = numpy.zeros((len(nb), len(output)), dtype=numpy.float64)
+
+        kinds = numpy.array(kinds, dtype=numpy.int64)
+        sizes = numpy.array([dim + 1, 3, 3, 2], dtype=numpy.int64)[kinds]
+        first = numpy.zeros(kinds.shape[0] + 1, dtype=numpy.int64)
+        numpy.cumsum(sizes, out=first[1:])
+        final_shape = (tree.n_classes_, len(output) + 1)
+        buffer = numpy.zeros(first[-1] + final_shape[0] * final_shape[1],
+                             dtype=numpy.float64)
+
+        # threshold nodes, one per internal node of the tree, bias first
+        internal = numpy.arange(n_nodes)[children_left != children_right]
+        pos = first[:-1][kinds == 0]
+        buffer[pos] = threshold[internal] * k
+        buffer[pos + 1 + feature[internal]] = -k
+        # true, false nodes
+        for kind, coef in [(1, [-k * 1.5, k, k]), (2, [-k * 0.25, k, -k]),
+                           (3, [1., -1.])]:
+            pos = first[:-1][kinds == kind]
+            for j, c in enumerate(coef):
+                buffer[pos + j] = c
+        final_coef = buffer[first[-1]:].reshape(final_shape)
+        final_coef[:, 0] = -k / 2
         for i in range(0, tree.n_classes_):
-            coef[i, index[i]:index[i + 1]] = k
-        feat = [root[n.nodeid][1]['output'] for n in output]
-        root.append(
-            NeuralTreeNode(coef, bias=-k / 2,
-                           activation='softmax4', tag="Nfinal"),
-            feat)
-
-        # final
+            final_coef[i, index[i] + 1:index[i + 1] + 1] = k
+
+        activations = ['sigmoid4', 'sigmoid4', 'sigmoid4', 'identity']
+        first = first.tolist()
+        for j, (kind, tag, inp) in enumerate(zip(kinds.tolist(), tags, inputs)):
+            node = NeuralTreeNode._from_coef(
+                buffer[first[j]: first[j + 1]], activations[kind], tag=tag)
+            node.nodeid = j
+            root.nodes.append(node)
+            root.nodes_attr.append(dict(
+                inputs=inp, output=dim + j, coef_size=first[j + 1] - first[j],
+                first_coef=first[j]))
+
+        node = NeuralTreeNode._from_coef(
+            final_coef, 'softmax4', tag="Nfinal")
+        node.nodeid = len(root.nodes)
+        root.nodes.append(node)
+        root.nodes_attr.append(dict(
+            inputs=numpy.array([dim + j for j in output]),
+            output=list(range(dim + node.nodeid,
+                              dim + node.nodeid + tree.n_classes_)),
+            coef_size=final_coef.size, first_coef=first[-1]))
+        root._update_members(buffer=buffer)
         return root
 
     def to_dot(self, X=None):
@@ -363,20 +528,12 @@ class NeuralTreeNet(_TrainingAPI):
     @property
     def shape(self):
         "Returns the shape of the coefficients."
-        return (sum(n.coef.size for n in self.nodes), )
+        return self.coefs_.shape
 
     @property
     def training_weights(self):
         "Returns the weights."
-        sh = self.shape
-        res = numpy.empty(sh[0], dtype=numpy.float64)
-        pos = 0
-        for n in self.nodes:
-            s = n.coef.size
-            res[pos: pos + s] = (
-                n.coef if len(n.coef.shape) == 1 else n.coef.ravel())
-            pos += s
-        return res
+        return self.coefs_.copy()
 
     def update_training_weights(self, X, add=True):
         """
@@ -385,85 +542,92 @@ class NeuralTreeNet(_TrainingAPI):
         :param grad: vector to add to the weights such as gradient
         :param add: addition or replace
         """
-        pos = 0
+        # every node coefficients is a view on self.coefs_
         if add:
-            for n in self.nodes:
-                s = n.coef.size
-                n.coef += X[pos: pos + s].reshape(n.coef.shape)
-                pos += s
+            self.coefs_ += X
         else:
-            for n in self.nodes:
-                s = n.coef.size
-                numpy.copyto(n.coef, X[pos: pos + s].reshape(n.coef.shape))
-                pos += s
+            numpy.copyto(self.coefs_, X)
 
     def fill_cache(self, X):
         """
         Creates a cache with intermediate results.
+        If *X* is a matrix, every node processes all rows at once
+        and ``big_cache[-1]`` is a matrix *(n, size_)*.
+        The cache only holds this buffer, the output of every node
+        is a view on it retrieved with the evaluation plan.
         """
-        big_cache = {}
-        res = numpy.zeros((self.size_,), dtype=numpy.float64)
-        res[:self.dim] = X
-        for node, attr in zip(self.nodes, self.nodes_attr):
-            cache = node.fill_cache(res[attr['inputs']])
-            big_cache[node.nodeid] = cache
-            res[attr['output']] = cache['aX']
-        big_cache[-1] = res
-        return big_cache
+        # every position is written by the inputs or by one node
+        res = numpy.empty(X.shape[:-1] + (self.size_, ), dtype=numpy.float64)
+        res[..., :self.dim] = X
+        for predict, inputs, output, _, _ in self.plan_:
+            res[..., output] = predict(res[..., inputs])
+        return {-1: res}
+
+    def _get_output_node_step(self, nb_last):
+        """
+        Retrieves the output node, its attributes and its step
+        in the evaluation plan.
+        *nb_last* is the number of expected outputs.
+        The result is cached until the network is modified.
+        """
+        if nb_last in self.output_node_cache_:
+            return self.output_node_cache_[nb_last]
+        neurones = numpy.unique(
+            self.output_to_node_[self.size_ - nb_last: self.size_])
+        if neurones.shape[0] != 1 or neurones[0] < 0:
+            raise RuntimeError(  # pragma: no cover
+                "Only one output node is implemented not {}".format(
+                    neurones.shape[0]))
+        index = neurones[0]
+        res = self.nodes[index], self.nodes_attr[index], self.plan_[index]
+        self.output_node_cache_[nb_last] = res
+        return res
 
     def _get_output_node_attr(self, nb_last):
         """
         Retrieves the output nodes.
         *nb_last* is the number of expected outputs.
         """
-        neurones = set(self.output_to_node_[i][0].nodeid
-                       for i in range(self.size_ - nb_last, self.size_))
-        if len(neurones) != 1:
-            raise RuntimeError(  # pragma: no cover
-                "Only one output node is implemented not {}".format(
-                    len(neurones)))
-        return self.output_to_node_[self.size_ - 1]
+        return self._get_output_node_step(nb_last)[:2]
 
     def _common_loss_dloss(self, X, y, cache=None):
         """
         Common beginning to methods *loss*, *dlossds*,
-        *dlossdw*.
+        *dlossdw*. Returns the output node, its inputs
+        and a cache holding its predictions which are
+        already computed in the network buffer.
         """
         last = 1 if len(y.shape) <= 1 else y.shape[1]
         if cache is not None and -1 in cache:
             res = cache[-1]
         else:
             res = self.predict(X)
-        if len(res.shape) == 2:
-            pred = res[:, -last:]
-        else:
-            pred = res[-last:]
-        last_node, last_attr = self._get_output_node_attr(last)
-        return res, pred, last_node, last_attr
+        last_node, _, (_, inputs, output, _, _) = self._get_output_node_step(
+            last)
+        return last_node, res[..., inputs], dict(aX=res[..., output])
 
     def loss(self, X, y, cache=None):
         """
         Computes the loss due to prediction error. Returns a float.
         """
-        res, _, last_node, last_attr = self._common_loss_dloss(
+        last_node, last_inputs, last_cache = self._common_loss_dloss(
             X, y, cache=cache)
-        if len(res.shape) <= 1:
-            return last_node.loss(res[last_attr['inputs']], y)  # pylint: disable=E1120
-        return last_node.loss(res[:, last_attr['inputs']], y)  # pylint: disable=E1120
+        return last_node.loss(last_inputs, y, cache=last_cache)  # pylint: disable=E1120
 
     def dlossds(self, X, y, cache=None):
         """
         Computes the loss derivative against the inputs.
         """
-        res, _, last_node, last_attr = self._common_loss_dloss(
+        last_node, last_inputs, last_cache = self._common_loss_dloss(
             X, y, cache=cache)
-        if len(res.shape) <= 1:
-            return last_node.dlossds(res[last_attr['inputs']], y)  # pylint: disable=E1120
-        return last_node.dlossds(res[:, last_attr['inputs']], y)  # pylint: disable=E1120
+        return last_node.dlossds(last_inputs, y, cache=last_cache)  # pylint: disable=E1120
 
     def gradient_backward(self, graddx, X, inputs=False, cache=None):
         """
         Computes the gradient in X.
+        If *X* is a matrix, the gradient against the coefficients
+        is the sum of the gradients of every row, the gradient
+        against the inputs has one row per observation.
 
         :param graddx: existing gradient against the inputs
         :param X: computes the gradient in X
@@ -474,31 +638,31 @@ class NeuralTreeNet(_TrainingAPI):
         """
         if cache is None:
             cache = self.fill_cache(X)
-        shape = self.training_weights.shape
-        pred = self.predict(X)
+        # the cache already holds the forward pass,
+        # no need to call predict again
+        shape = self.shape
+        pred = cache[-1]
+        batch = len(pred.shape) == 2
 
         whole_gradx = numpy.zeros(pred.shape, dtype=numpy.float64)
-        whole_gradw = numpy.zeros(shape, dtype=numpy.float64)
-        if len(graddx.shape) == 0:
+        # every node writes its own part of the gradient
+        whole_gradw = numpy.empty(shape, dtype=numpy.float64)
+        if batch:
+            if len(graddx.shape) == 1:
+                whole_gradx[:, -1] = graddx
+            else:
+                whole_gradx[:, -graddx.shape[1]:] = graddx
+        elif len(graddx.shape) == 0:
             whole_gradx[-1] = graddx
         else:
             whole_gradx[-graddx.shape[0]:] = graddx
 
-        for node, attr in zip(self.nodes[::-1], self.nodes_attr[::-1]):
-            ch = cache[node.nodeid]
-
-            node_graddx = whole_gradx[attr['output']]
-            xi = pred[attr['inputs']]
-
-            temp_gradw = node.gradient_backward(
-                node_graddx, xi, inputs=False, cache=ch)
-            temp_gradx = node.gradient_backward(
-                node_graddx, xi, inputs=True, cache=ch)
-
-            whole_gradw[attr['first_coef']:attr['first_coef'] +
-                        attr['coef_size']] += temp_gradw.reshape((attr['coef_size'],))
-            whole_gradx[attr['inputs']
-                        ] += temp_gradx.reshape((len(attr['inputs']),))
+        for _, node_inputs, node_output, node, coefs in reversed(self.plan_):
+            _, temp_gradx = node._gradient_backward_both(
+                whole_gradx[..., node_output], pred[..., node_inputs],
+                cache=dict(aX=pred[..., node_output]),
+                out=whole_gradw[coefs].reshape(node.coef.shape))
+            whole_gradx[..., node_inputs] += temp_gradx
 
         if inputs:
             return whole_gradx